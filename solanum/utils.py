@@ -1,14 +1,20 @@
+import os
+
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-def plot_df_grid(df, date_col='Date', layout=None, figsize=(12, 10), sharex=True, grid=True):
+def plot_df_grid(df, date_col='Date', layout=None, figsize=(12, 10), sharex=True, grid=True, max_points=None):
     if date_col in df.columns:
         df = df.copy()
         df[date_col] = pd.to_datetime(df[date_col])
         df = df.set_index(date_col)
 
     df_num = df.select_dtypes(include=[np.number])
+    if max_points is not None:
+        df_num = downsample_df(df_num, max_points)
 
     ncols = int(np.ceil(np.sqrt(len(df_num.columns)))) if layout is None else layout[1]
     nrows = int(np.ceil(len(df_num.columns) / ncols)) if layout is None else layout[0]
@@ -31,4 +37,363 @@ def plot_df_grid(df, date_col='Date', layout=None, figsize=(12, 10), sharex=True
         ax.set_visible(False)
 
     plt.tight_layout()
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+def _bucket_starts(n, max_points):
+    # Start offsets of max_points contiguous, near-equal buckets over n rows
+    return np.unique(np.linspace(0, n, max_points, endpoint=False).astype(np.int64))
+
+
+def downsample_df(df, max_points, how='mean'):
+    """Reduce df to at most max_points rows by aggregating contiguous buckets.
+
+    `how` is 'mean', 'min' or 'max', or a dict mapping columns to one of
+    those. Each bucket is labelled with the index of its first row.
+    """
+    n = len(df)
+    if max_points is None or n <= max_points:
+        return df
+
+    starts = _bucket_starts(n, max_points)
+
+    def nanmean(a):
+        valid = ~np.isnan(a)
+        total = np.add.reduceat(np.where(valid, a, 0.0), starts, axis=0)
+        count = np.add.reduceat(valid, starts, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count
+
+    # NaN-ignoring reductions, so one missing day does not blank its bucket
+    reducers = {
+        'mean': nanmean,
+        'min':  lambda a: np.fmin.reduceat(a, starts, axis=0),
+        'max':  lambda a: np.fmax.reduceat(a, starts, axis=0),
+    }
+
+    if isinstance(how, dict):
+        how_by_col = {c: how.get(c, 'mean') for c in df.columns}
+    else:
+        how_by_col = {c: how for c in df.columns}
+
+    out = {}
+    for h in set(how_by_col.values()):
+        cols = [c for c in df.columns if how_by_col[c] == h]
+        values = reducers[h](df[cols].to_numpy(dtype=np.float64))
+        out.update(zip(cols, values.T))
+
+    return pd.DataFrame(out, index=df.index[starts], columns=df.columns)
+
+
+def _nan_quantiles(values, quantiles):
+    # Linear-interpolated quantiles along axis 0 that skip NaNs, computed for
+    # all columns at once (np.nanquantile loops over columns in Python)
+    nan = np.isnan(values)
+    if not nan.any():
+        return np.quantile(values, quantiles, axis=0)
+
+    values = np.sort(values, axis=0)  # NaNs sort last
+    last = np.maximum((~nan).sum(axis=0) - 1, 0)
+    pos = np.asarray(quantiles, dtype=np.float64)[:, None] * last
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, last)
+    v_lo = np.take_along_axis(values, lo, axis=0)
+    v_hi = np.take_along_axis(values, hi, axis=0)
+    return v_lo + (pos - lo) * (v_hi - v_lo)
+
+
+def _check_run_dates(run_dates, dates, label):
+    # Validate a run's dates against the first run's; returns the reference dates
+    if run_dates.has_duplicates:
+        raise ValueError(f"{label} has duplicate dates.")
+    if not run_dates.is_monotonic_increasing:
+        raise ValueError(f"{label} dates are not in increasing order.")
+    if dates is None:
+        return run_dates
+    if not run_dates.isin(dates).any():
+        raise ValueError(f"{label} shares no dates with the first run.")
+    return dates
+
+
+def _iter_stored_run_dates(path, date_col, run_col, chunksize):
+    # Yield (run id, dates) for each run of a long-format CSV, reading it in chunks
+    seen = set()
+    current, parts = None, []
+    for chunk in pd.read_csv(path, usecols=[run_col, date_col], chunksize=chunksize):
+        ids = chunk[run_col].to_numpy()
+        bounds = np.flatnonzero(ids[1:] != ids[:-1]) + 1
+        for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(ids)]):
+            run_id = ids[start]
+            if not parts or run_id != current:
+                if parts:
+                    yield current, pd.concat(parts)
+                if run_id in seen:
+                    raise ValueError(f"Rows of run {run_id} in {path} are not contiguous.")
+                seen.add(run_id)
+                current, parts = run_id, []
+            parts.append(chunk[date_col].iloc[start:stop])
+    if parts:
+        yield current, pd.concat(parts)
+
+
+def _is_path(run):
+    return isinstance(run, (str, os.PathLike))
+
+
+def _frame_dates(df, date_col):
+    # Dates of a result DataFrame, from its date column or a date-named index
+    if date_col in df.columns:
+        return df[date_col]
+    if df.index.name == date_col:
+        return df.index.to_series()
+    raise ValueError(f"Run has no '{date_col}' column or index.")
+
+
+def _numeric_columns(run, date_col, run_col):
+    if _is_path(run):
+        run = pd.read_csv(run, nrows=1000)
+    return [c for c in run.select_dtypes(include=[np.number]).columns if c not in (date_col, run_col)]
+
+
+def _day_blocks(n, block_days):
+    starts = np.arange(0, n, block_days)
+    return starts, np.minimum(starts + block_days, n)
+
+
+def _iter_run_dates(runs, stored, date_col, run_col, chunksize):
+    # Yield (label, source, first row in source, dates) for each run
+    if stored:
+        row = 0
+        for run_id, run_dates in _iter_stored_run_dates(runs, date_col, run_col, chunksize):
+            yield f"Run {run_id}", runs, row, run_dates
+            row += len(run_dates)
+        return
+
+    for i, run in enumerate(runs):
+        if _is_path(run):
+            run_dates = pd.read_csv(run, usecols=[date_col])[date_col]
+        else:
+            run_dates = _frame_dates(run, date_col)
+        yield f"Run {i}", run, 0, run_dates
+
+
+def _line_offsets(path, lines, bufsize=1 << 22):
+    # Byte offset at which each of the given (sorted) 0-based lines starts.
+    # Lines are split on raw newlines, so quoted fields must not contain any,
+    # which holds for files written by DataFrame.to_csv with numeric results.
+    offsets = np.empty(len(lines), dtype=np.int64)
+    found = int(np.searchsorted(lines, 0, side='right'))
+    offsets[:found] = 0
+    newlines, pos = 0, 0
+    with open(path, 'rb') as f:
+        while found < len(lines):
+            buf = f.read(bufsize)
+            if not buf:
+                break
+            nl = np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == ord('\n'))
+            # Line k starts right after the k-th newline of the file
+            k = lines[found:] - newlines - 1
+            n = int(np.searchsorted(k, len(nl)))
+            offsets[found:found + n] = pos + nl[k[:n]] + 1
+            found += n
+            newlines += len(nl)
+            pos += len(buf)
+    offsets[found:] = pos
+    return offsets
+
+
+def _read_rows(path, offset, nrows, names, usecols):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return pd.read_csv(f, header=None, names=names, usecols=usecols, nrows=nrows)
+
+
+def _fill_block(part_dates, row, part, columns, block_dates, block):
+    day = block_dates.get_indexer(pd.to_datetime(part_dates))
+    keep = day >= 0
+    for c in columns:
+        block[c][row, day[keep]] = part[c].to_numpy(dtype=np.float32)[keep]
+
+
+def summarize_ensemble(runs, date_col='Date', columns=None, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95),
+                       run_col='run', chunksize=100000, block_days=1000):
+    """Per-day quantiles of each numeric column across an ensemble of runs.
+
+    `runs` is a sequence of result DataFrames (dated by `date_col` as a
+    column or index) or CSV paths (as written by
+    SolanumModel.save_results_csv), or the path to a single long-format CSV
+    holding every run, told apart by `run_col`, with each run's rows
+    contiguous. Dates must be unique and increasing within a run and are
+    aligned on the first run's; days a run lacks are ignored.
+
+    A first pass reads only the date column of every run, plus a raw
+    newline scan of each CSV to find where each block's rows start. The
+    ensemble is then reduced `block_days` days at a time, reading just
+    those rows of each run, so at most one float32 array of
+    n_runs x block_days per selected column is held at once.
+
+    Returns a DataFrame indexed by date with (column, quantile) MultiIndex
+    columns.
+    """
+    stored = _is_path(runs)
+    if isinstance(runs, pd.DataFrame):
+        raise TypeError("runs must be a sequence of runs, not a DataFrame; pass [df] for a single run.")
+    if not stored:
+        if iter(runs) is runs:
+            raise TypeError("runs must be a sequence, not an iterator: it is read once per block of days.")
+        runs = list(runs)
+        if not runs:
+            raise ValueError("No runs found to summarize.")
+    columns = _numeric_columns(runs if stored else runs[0], date_col, run_col) if columns is None else list(columns)
+
+    # First pass reads dates only: validates runs and locates each block's rows
+    dates = None
+    sources, first_rows, rows, aligned = [], [], [], []
+    for label, source, first_row, run_dates in _iter_run_dates(runs, stored, date_col, run_col, chunksize):
+        run_dates = pd.DatetimeIndex(pd.to_datetime(run_dates))
+        dates = _check_run_dates(run_dates, dates, label)
+        if not rows:
+            starts, stops = _day_blocks(len(dates), block_days)
+        sources.append(source)
+        first_rows.append(first_row)
+        aligned.append(run_dates.equals(dates))
+        rows.append(np.stack([run_dates.searchsorted(dates[starts], side='left'),
+                              run_dates.searchsorted(dates[stops - 1], side='right')], axis=1))
+    if dates is None:
+        raise ValueError("No runs found to summarize.")
+    n_runs = len(sources)
+    rows = np.stack(rows)
+
+    # Byte offset of each run's first row in every block, one scan per file
+    offsets = np.zeros((n_runs, len(starts)), dtype=np.int64)
+    names = {}
+    by_path = {}
+    for i, source in enumerate(sources):
+        if _is_path(source):
+            by_path.setdefault(source, []).append(i)
+    for path, idx in by_path.items():
+        names[path] = list(pd.read_csv(path, nrows=0).columns)
+        lines = (np.asarray(first_rows)[idx, None] + rows[idx, :, 0] + 1).ravel()
+        order = np.argsort(lines, kind='stable')
+        flat = np.empty(len(lines), dtype=np.int64)
+        flat[order] = _line_offsets(path, lines[order])
+        offsets[idx] = flat.reshape(len(idx), -1)
+
+    quantiles = list(quantiles)
+    out = {(c, q): np.empty(len(dates)) for c in columns for q in quantiles}
+    for b, (start, stop) in enumerate(zip(starts, stops)):
+        block_dates = dates[start:stop]
+        block = {c: np.full((n_runs, stop - start), np.nan, dtype=np.float32) for c in columns}
+        for i, source in enumerate(sources):
+            r0, r1 = rows[i, b]
+            if r1 <= r0:
+                continue
+            # Runs dated like the first one map row for row, without parsing dates
+            usecols = columns if aligned[i] else [date_col] + columns
+            if _is_path(source):
+                part = _read_rows(source, offsets[i, b], r1 - r0, names[source], usecols)
+            else:
+                part = source.iloc[r0:r1]
+            if aligned[i]:
+                for c in columns:
+                    block[c][i] = part[c].to_numpy(dtype=np.float32)
+            else:
+                part_dates = part[date_col] if _is_path(source) else _frame_dates(part, date_col)
+                _fill_block(part_dates, i, part, columns, block_dates, block)
+
+        for c in columns:
+            bands = _nan_quantiles(block.pop(c), quantiles)
+            for q, band in zip(quantiles, bands):
+                out[(c, q)][start:stop] = band
+
+    summary = pd.DataFrame(out, index=dates)
+    summary.columns = pd.MultiIndex.from_tuples(summary.columns, names=['variable', 'quantile'])
+    return summary
+
+
+def _downsample_summary(summary, max_points):
+    # Keep bands as envelopes: lower quantiles take the bucket minimum,
+    # upper quantiles the maximum and the median the mean.
+    how = {}
+    for col in summary.columns:
+        q = col[1]
+        how[col] = 'min' if q < 0.5 else 'max' if q > 0.5 else 'mean'
+    return downsample_df(summary, max_points, how=how)
+
+
+def plot_ensemble_grid(runs, out_path=None, date_col='Date', columns=None,
+                       quantiles=(0.05, 0.25, 0.5, 0.75, 0.95), max_points=2000, layout=None,
+                       figsize=(12, 10), sharex=True, grid=True, dpi=100, run_col='run',
+                       chunksize=100000, block_days=1000):
+    """Plot median and quantile bands of an ensemble, one panel per variable.
+
+    `runs` is anything accepted by summarize_ensemble, or a summary it
+    returned. With `out_path` the figure is rendered off-screen with the Agg
+    canvas and saved there; otherwise it is shown with pyplot.
+    """
+    if isinstance(runs, pd.DataFrame) and isinstance(runs.columns, pd.MultiIndex):
+        summary = runs
+    else:
+        summary = summarize_ensemble(runs, date_col=date_col, columns=columns, quantiles=quantiles,
+                                     run_col=run_col, chunksize=chunksize, block_days=block_days)
+    summary = _downsample_summary(summary, max_points)
+
+    variables = list(summary.columns.get_level_values(0).unique())
+    ncols = int(np.ceil(np.sqrt(len(variables)))) if layout is None else layout[1]
+    nrows = int(np.ceil(len(variables) / ncols)) if layout is None else layout[0]
+
+    if out_path is None:
+        fig = plt.figure(figsize=figsize)
+    else:
+        fig = Figure(figsize=figsize)
+        FigureCanvasAgg(fig)
+    axes = fig.subplots(nrows, ncols, sharex=sharex, squeeze=False)
+
+    x = summary.index
+    for ax, var in zip(axes.flat, variables):
+        bands = summary[var]
+        qs = sorted(bands.columns)
+        # Pair outermost quantiles first so inner bands draw darker on top
+        pairs = [(qs[i], qs[-1 - i]) for i in range(len(qs) // 2)]
+        for k, (lo, hi) in enumerate(pairs):
+            ax.fill_between(x, bands[lo], bands[hi], color='C0', linewidth=0,
+                            alpha=0.2 + 0.3 * k / max(len(pairs), 1))
+        if 0.5 in bands.columns:
+            ax.plot(x, bands[0.5], color='C0', linewidth=1)
+        ax.set_title(var, fontsize=10)
+        ax.grid(grid)
+
+    for ax in axes.flat[len(variables):]:
+        ax.set_visible(False)
+
+    # Rotate dates on every panel and keep them on the lowest visible panel
+    # of each column, since sharex hides them on all but the bottom row
+    for j in range(ncols):
+        visible = [ax for ax in axes[:, j] if ax.get_visible()]
+        if visible:
+            visible[-1].tick_params(axis='x', labelbottom=True)
+        for ax in visible:
+            for label in ax.get_xticklabels():
+                label.set_rotation(30)
+                label.set_horizontalalignment('right')
+    fig.tight_layout()
+    if out_path is None:
+        plt.show()
+    else:
+        fig.savefig(out_path, dpi=dpi)
+    return summary
+
+
+def save_ensemble_grids(ensembles, out_dir, fmt='png', **kwargs):
+    """Render one ensemble grid per entry of `ensembles` (name -> runs) to out_dir.
+
+    Extra keyword arguments are passed to plot_ensemble_grid. Returns the
+    written file paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for name, runs in ensembles.items():
+        path = os.path.join(out_dir, f"{name}.{fmt}")
+        plot_ensemble_grid(runs, out_path=path, **kwargs)
+        paths.append(path)
+    return paths